@@ -1,5 +1,7 @@
 import os
 import re
+import asyncio
+import signal
 from datetime import datetime, date, time
 from io import BytesIO
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -11,6 +13,8 @@ import logging
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from database import Database
+from sender import SendScheduler
+from profiling import profiler, span, traced
 
 # Настройка логирования
 logging.basicConfig(
@@ -35,9 +39,42 @@ except ImportError:
 db = Database()
 bot_application = None
 
+# Все исходящие запросы к Telegram идут через единый планировщик
+sender = SendScheduler()
+
+# Сколько обновлений от пользователей обрабатывается одновременно
+CONCURRENT_UPDATES = 32
+
+# Сколько пользователей рассылка обслуживает одновременно
+BROADCAST_CONCURRENCY = 8
+
+# Не даем двум проверкам (по расписанию, /check_now, /profile_check) идти одновременно
+weekly_check_lock = asyncio.Lock()
+
 # Канал для обязательной подписки
 REQUIRED_CHANNEL = "@savinih_vitaliy"  # или ID канала в формате -100xxxxxxxxxx
 
+def parse_admin_ids(value: str) -> set:
+    """Разбирает список ID администраторов, пропуская некорректные значения"""
+    admin_ids = set()
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            admin_ids.add(int(item))
+        except ValueError:
+            logger.warning(f"Некорректный ID администратора в ADMIN_IDS пропущен: {item!r}")
+    return admin_ids
+
+
+# Администраторы, которым доступны команды профилирования (ID через запятую)
+ADMIN_IDS = parse_admin_ids(os.getenv('ADMIN_IDS', ''))
+
+# Длительность профилирования по умолчанию для команды /profile (в секундах)
+DEFAULT_PROFILE_SECONDS = 30
+MAX_PROFILE_SECONDS = 600
+
 
 async def check_subscription(user_id: int) -> bool:
     """
@@ -45,7 +82,8 @@ async def check_subscription(user_id: int) -> bool:
     Возвращает True, если подписан, False в противном случае.
     """
     try:
-        member = await bot_application.bot.get_chat_member(
+        member = await sender.interactive(
+            bot_application.bot.get_chat_member,
             chat_id=REQUIRED_CHANNEL,
             user_id=user_id
         )
@@ -247,6 +285,17 @@ def generate_life_calendar(weeks_lived: int, birth_date: date) -> BytesIO:
     return bio
 
 
+async def render_life_calendar(weeks_lived: int, birth_date: date) -> BytesIO:
+    """
+    Генерирует изображение в отдельном потоке, чтобы отрисовка
+    не блокировала event loop и обработку остальных обновлений.
+    """
+    loop = asyncio.get_running_loop()
+    with span("render"):
+        return await loop.run_in_executor(None, generate_life_calendar, weeks_lived, birth_date)
+
+
+@traced("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     # Проверяем подписку на канал
@@ -260,7 +309,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await update.message.reply_text(
+        await sender.interactive(
+            update.message.reply_text,
             "👋 Привет!\n\n"
             "❌ Для использования бота необходимо подписаться на наш канал!\n\n"
             "📢 Подпишитесь на канал и нажмите «Проверить подписку»:",
@@ -275,27 +325,106 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "дд.мм.гггг или дд/мм/гггг\n\n"
         "📌 Например: 23.10.2004"
     )
-    await update.message.reply_text(welcome_text)
+    await sender.interactive(update.message.reply_text, welcome_text)
 
 
 async def check_now(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда для ручной проверки обновлений (для тестирования)"""
-    await update.message.reply_text("Запускаю проверку еженедельных обновлений...")
-    await check_weekly_updates()
-    await update.message.reply_text("Проверка завершена!")
+    await sender.interactive(update.message.reply_text, "Запускаю проверку еженедельных обновлений...")
+    if await check_weekly_updates():
+        await sender.interactive(update.message.reply_text, "Проверка завершена!")
+    else:
+        await sender.interactive(update.message.reply_text, "Проверка уже выполняется.")
+
+
+def is_admin(user_id: int) -> bool:
+    """Проверяет, входит ли пользователь в список администраторов"""
+    return user_id in ADMIN_IDS
+
+
+async def send_profile_result(update: Update, prof_path: str, txt_path: str):
+    """Отправляет администратору путь к профилю и текстовую сводку"""
+    await sender.interactive(
+        update.message.reply_text,
+        f"Профиль сохранен: {prof_path}\n"
+        f"Открыть: python -m pstats {prof_path}"
+    )
+    with open(txt_path, 'rb') as f:
+        await sender.interactive(update.message.reply_document, document=f, filename=os.path.basename(txt_path))
+
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /profile [секунд] — профилирует работу бота заданное время (только для администраторов)"""
+    if not is_admin(update.effective_user.id):
+        return
+    
+    seconds = DEFAULT_PROFILE_SECONDS
+    if context.args:
+        try:
+            seconds = int(context.args[0])
+        except ValueError:
+            await sender.interactive(update.message.reply_text, "Использование: /profile [секунд]")
+            return
+        seconds = max(1, min(seconds, MAX_PROFILE_SECONDS))
+    
+    # Запускаем профилировщик до первого await, чтобы повторная команда
+    # или сигнал не успели запустить его параллельно
+    try:
+        profiler.start("profile")
+    except RuntimeError:
+        await sender.interactive(update.message.reply_text, "Профилирование уже запущено.")
+        return
+    
+    try:
+        await sender.interactive(update.message.reply_text, f"Профилирую работу бота {seconds} с...")
+        await asyncio.sleep(seconds)
+    finally:
+        prof_path, txt_path = profiler.stop()
+    await send_profile_result(update, prof_path, txt_path)
+
 
+async def profile_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /profile_check — профилирует один запуск check_weekly_updates (только для администраторов)"""
+    if not is_admin(update.effective_user.id):
+        return
+    
+    if weekly_check_lock.locked():
+        await sender.interactive(update.message.reply_text, "Проверка уже выполняется.")
+        return
+    
+    try:
+        profiler.start("weekly_check")
+    except RuntimeError:
+        await sender.interactive(update.message.reply_text, "Профилирование уже запущено.")
+        return
+    
+    try:
+        await sender.interactive(
+            update.message.reply_text,
+            "Запускаю проверку еженедельных обновлений под профилировщиком..."
+        )
+        completed = await check_weekly_updates()
+    finally:
+        prof_path, txt_path = profiler.stop()
+    
+    if not completed:
+        await sender.interactive(update.message.reply_text, "Проверка уже выполняется, профиль не содержит рассылки.")
+    await send_profile_result(update, prof_path, txt_path)
 
+
+@traced("button_callback")
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик нажатий на inline кнопки"""
     query = update.callback_query
-    await query.answer()
+    await sender.interactive(query.answer)
     
     if query.data == "check_sub":
         # Проверяем подписку
         is_subscribed = await check_subscription(query.from_user.id)
         
         if is_subscribed:
-            await query.edit_message_text(
+            await sender.interactive(
+                query.edit_message_text,
                 "✅ Отлично! Вы подписаны на канал.\n\n"
                 "Теперь отправьте мне дату своего рождения в формате дд.мм.гггг или дд/мм/гггг\n"
                 "Например: 23.10.2004"
@@ -307,13 +436,15 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            await query.edit_message_text(
+            await sender.interactive(
+                query.edit_message_text,
                 "❌ Вы еще не подписаны на канал!\n\n"
                 "Пожалуйста, подпишитесь и нажмите «Проверить подписку» снова:",
                 reply_markup=reply_markup
             )
 
 
+@traced("handle_birthdate")
 async def handle_birthdate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик сообщения с датой рождения"""
     user_input = update.message.text.strip()
@@ -329,7 +460,8 @@ async def handle_birthdate(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await update.message.reply_text(
+        await sender.interactive(
+            update.message.reply_text,
             "❌ Для использования бота необходимо подписаться на наш канал!\n\n"
             "📢 Подпишитесь на канал и нажмите «Проверить подписку»:",
             reply_markup=reply_markup
@@ -341,7 +473,8 @@ async def handle_birthdate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     match = re.match(date_pattern, user_input)
     
     if not match:
-        await update.message.reply_text(
+        await sender.interactive(
+            update.message.reply_text,
             "Неверный формат даты. Пожалуйста, используйте формат дд.мм.гггг или дд/мм/гггг\n"
             "Например: 23.10.2004"
         )
@@ -353,17 +486,18 @@ async def handle_birthdate(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Проверяем, что дата не в будущем
         if birth_date > date.today():
-            await update.message.reply_text("Дата рождения не может быть в будущем!")
+            await sender.interactive(update.message.reply_text, "Дата рождения не может быть в будущем!")
             return
         
         # Проверяем разумность даты (не более 120 лет)
         age_in_years = (date.today() - birth_date).days / 365.25
         if age_in_years > 120:
-            await update.message.reply_text("Пожалуйста, проверьте правильность даты рождения.")
+            await sender.interactive(update.message.reply_text, "Пожалуйста, проверьте правильность даты рождения.")
             return
         
     except ValueError:
-        await update.message.reply_text(
+        await sender.interactive(
+            update.message.reply_text,
             "Некорректная дата. Проверьте правильность введенных данных."
         )
         return
@@ -374,12 +508,13 @@ async def handle_birthdate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Сохраняем пользователя в базу данных
     try:
         user = update.effective_user
-        db.save_user(
-            user_id=user.id,
-            birth_date=birth_date,
-            username=user.username,
-            first_name=user.first_name
-        )
+        with span("db.save_user"):
+            db.save_user(
+                user_id=user.id,
+                birth_date=birth_date,
+                username=user.username,
+                first_name=user.first_name
+            )
         logger.info(f"Пользователь {user.id} сохранен в базе данных")
     except Exception as e:
         logger.error(f"Ошибка при сохранении пользователя: {e}")
@@ -391,23 +526,25 @@ async def handle_birthdate(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🔔 Теперь я буду присылать вам обновленную таблицу каждую неделю!"
     )
     
-    await update.message.reply_text(response_text)
+    await sender.interactive(update.message.reply_text, response_text)
     
     # Генерируем и отправляем изображение
     try:
-        await update.message.reply_text("Генерирую изображение...")
-        image_bio = generate_life_calendar(weeks, birth_date)
-        await update.message.reply_photo(photo=image_bio)
+        await sender.interactive(update.message.reply_text, "Генерирую изображение...")
+        image_bio = await render_life_calendar(weeks, birth_date)
+        await sender.interactive(update.message.reply_photo, photo=image_bio)
         
         # Обновляем номер последней отправленной недели
-        db.update_last_week_sent(update.effective_user.id, weeks)
+        with span("db.update_last_week_sent"):
+            db.update_last_week_sent(update.effective_user.id, weeks)
         
         logger.info(f"Успешно отправлено изображение для пользователя {update.effective_user.id}")
     except Exception as e:
         logger.error(f"Ошибка при генерации изображения: {e}")
-        await update.message.reply_text("Извините, произошла ошибка при генерации изображения.")
+        await sender.interactive(update.message.reply_text, "Извините, произошла ошибка при генерации изображения.")
 
 
+@traced("send_weekly_update")
 async def send_weekly_update(user_id: int, birth_date: date, current_week: int):
     """Отправляет еженедельное обновление пользователю"""
     try:
@@ -422,20 +559,23 @@ async def send_weekly_update(user_id: int, birth_date: date, current_week: int):
         )
         
         # Отправляем сообщение
-        await bot_application.bot.send_message(
+        await sender.bulk(
+            bot_application.bot.send_message,
             chat_id=user_id,
             text=message_text
         )
         
         # Генерируем и отправляем изображение
-        image_bio = generate_life_calendar(weeks, birth_date)
-        await bot_application.bot.send_photo(
+        image_bio = await render_life_calendar(weeks, birth_date)
+        await sender.bulk(
+            bot_application.bot.send_photo,
             chat_id=user_id,
             photo=image_bio
         )
         
         # Обновляем номер последней отправленной недели
-        db.update_last_week_sent(user_id, current_week)
+        with span("db.update_last_week_sent"):
+            db.update_last_week_sent(user_id, current_week)
         
         logger.info(f"Отправлено еженедельное обновление пользователю {user_id}, неделя {current_week}")
         
@@ -445,27 +585,66 @@ async def send_weekly_update(user_id: int, birth_date: date, current_week: int):
         logger.error(f"Неожиданная ошибка при отправке обновления пользователю {user_id}: {e}")
 
 
-async def check_weekly_updates():
-    """Проверяет и отправляет еженедельные обновления всем пользователям"""
-    logger.info("Запуск проверки еженедельных обновлений...")
+async def check_weekly_updates() -> bool:
+    """
+    Проверяет и отправляет еженедельные обновления всем пользователям.
+    Возвращает False, если проверка уже выполняется (по расписанию или командой).
+    """
+    if weekly_check_lock.locked():
+        logger.warning("Проверка еженедельных обновлений уже выполняется, повторный запуск пропущен")
+        return False
     
-    try:
-        users_to_update = db.get_users_for_weekly_update()
+    async with weekly_check_lock:
+        logger.info("Запуск проверки еженедельных обновлений...")
+        sender.reset_stats()
         
-        if users_to_update:
-            logger.info(f"Найдено {len(users_to_update)} пользователей для обновления")
-            
-            for user in users_to_update:
-                await send_weekly_update(
-                    user_id=user['user_id'],
-                    birth_date=user['birth_date_obj'],
-                    current_week=user['current_week']
-                )
-        else:
-            logger.info("Нет пользователей для обновления")
+        try:
+            with span("db.get_users_for_weekly_update"):
+                users_to_update = db.get_users_for_weekly_update()
             
-    except Exception as e:
-        logger.error(f"Ошибка при проверке обновлений: {e}")
+            if users_to_update:
+                logger.info(f"Найдено {len(users_to_update)} пользователей для обновления")
+                
+                # Несколько отправок одновременно держат очередь рассылки заполненной,
+                # а порядок и частоту запросов определяет планировщик отправки
+                semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+                
+                async def send_limited(user: dict):
+                    async with semaphore:
+                        await send_weekly_update(
+                            user_id=user['user_id'],
+                            birth_date=user['birth_date_obj'],
+                            current_week=user['current_week']
+                        )
+                
+                await asyncio.gather(*(send_limited(user) for user in users_to_update))
+            else:
+                logger.info("Нет пользователей для обновления")
+                
+        except Exception as e:
+            logger.error(f"Ошибка при проверке обновлений: {e}")
+        
+        sender.log_stats()
+    
+    return True
+
+
+async def post_init(application: Application):
+    """Запускает планировщик отправки внутри event loop приложения"""
+    sender.start()
+    
+    # SIGUSR1 включает/выключает профилирование (только Linux/Mac)
+    if hasattr(signal, 'SIGUSR1'):
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, profiler.toggle)
+            logger.info("Профилирование по сигналу: kill -USR1 <PID>")
+        except NotImplementedError:
+            pass
+
+
+async def post_stop(application: Application):
+    """Останавливает планировщик отправки, пока HTTP-клиент бота еще открыт"""
+    await sender.stop()
 
 
 def main():
@@ -473,12 +652,21 @@ def main():
     global bot_application
     
     # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .build()
+    )
     bot_application = application
     
     # Регистрируем обработчики
     application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("check_now", check_now))
+    application.add_handler(CommandHandler("check_now", check_now, block=False))
+    application.add_handler(CommandHandler("profile", profile, block=False))
+    application.add_handler(CommandHandler("profile_check", profile_check, block=False))
     application.add_handler(CallbackQueryHandler(button_callback))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_birthdate))
     
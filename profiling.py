@@ -0,0 +1,164 @@
+import contextvars
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Каталог для файлов профилирования
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+
+# Порог медленной операции в миллисекундах
+SLOW_OPERATION_MS = float(os.getenv('SLOW_OPERATION_MS', '500'))
+
+# Порог медленной обработки целого обновления в миллисекундах
+# (ответ с картинкой делает несколько запросов к Telegram, поэтому порог выше)
+SLOW_UPDATE_MS = float(os.getenv('SLOW_UPDATE_MS', '3000'))
+
+# Трасса текущего обновления (своя для каждой asyncio-задачи)
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Trace:
+    """Набор замеров (spans) в рамках обработки одного обновления"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started_at = time.perf_counter()
+        self.spans = []
+        self.slow_span_logged = False
+
+    def summary(self) -> str:
+        return ", ".join(f"{name}={duration * 1000:.0f} мс" for name, duration in self.spans)
+
+
+@contextmanager
+def trace(name: str):
+    """
+    Открывает трассу обновления. Если обработка заняла больше SLOW_UPDATE_MS
+    и ни один вложенный замер еще не попал в лог, пишется предупреждение
+    с разбивкой по замерам.
+    """
+    current = Trace(name)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        _current_trace.reset(token)
+        duration_ms = (time.perf_counter() - current.started_at) * 1000
+        if duration_ms >= SLOW_UPDATE_MS and not current.slow_span_logged:
+            logger.warning(f"Медленное обновление {name}: {duration_ms:.0f} мс ({current.summary()})")
+        else:
+            logger.debug(f"Обновление {name}: {duration_ms:.0f} мс ({current.summary()})")
+
+
+def record_span(name: str, duration: float):
+    """Добавляет замер в текущую трассу и логирует его, если он превысил порог"""
+    current = _current_trace.get()
+    if current is not None:
+        current.spans.append((name, duration))
+    if duration * 1000 >= SLOW_OPERATION_MS:
+        trace_name = "-"
+        if current is not None:
+            trace_name = current.name
+            current.slow_span_logged = True
+        logger.warning(f"Медленная операция {name}: {duration * 1000:.0f} мс (обновление {trace_name})")
+
+
+@contextmanager
+def span(name: str):
+    """Замеряет длительность операции и логирует ее, если она превысила порог"""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - started_at)
+
+
+def traced(name: str):
+    """Декоратор для обработчиков: каждый вызов выполняется в своей трассе"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with trace(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Profiler:
+    """
+    Включает cProfile по запросу, без перезапуска бота.
+    Профилируется поток event loop; отрисовка изображений в пуле потоков
+    в профиль не попадает — ее длительность видна по замерам render.
+    """
+
+    def __init__(self, profile_dir: str = PROFILE_DIR):
+        self.profile_dir = profile_dir
+        self._profile = None
+        self._label = None
+
+    @property
+    def active(self) -> bool:
+        return self._profile is not None
+
+    def start(self, label: str = "manual"):
+        """Включает профилирование"""
+        if self.active:
+            raise RuntimeError(f"Профилирование уже запущено ({self._label})")
+        self._profile = cProfile.Profile()
+        self._label = label
+        self._profile.enable()
+        logger.info(f"Профилирование запущено ({label})")
+
+    def stop(self) -> tuple:
+        """
+        Выключает профилирование и сохраняет статистику.
+        Возвращает пути к файлу .prof и к текстовой сводке.
+        """
+        if not self.active:
+            raise RuntimeError("Профилирование не запущено")
+
+        profile, label = self._profile, self._label
+        profile.disable()
+        self._profile = None
+        self._label = None
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        base_name = f"{label}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+        prof_path = os.path.join(self.profile_dir, base_name + ".prof")
+        txt_path = os.path.join(self.profile_dir, base_name + ".txt")
+
+        profile.dump_stats(prof_path)
+        with open(txt_path, 'w', encoding='utf-8') as f:
+            f.write(self.format_stats(profile))
+
+        logger.info(f"Профилирование остановлено, статистика сохранена в {prof_path}")
+        return prof_path, txt_path
+
+    def toggle(self):
+        """Включает или выключает профилирование (для обработчика сигнала)"""
+        if self.active:
+            if self._label != "signal":
+                logger.warning(f"Профилирование запущено командой ({self._label}), сигнал проигнорирован")
+                return
+            self.stop()
+        else:
+            self.start("signal")
+
+    @staticmethod
+    def format_stats(profile: cProfile.Profile, limit: int = 40) -> str:
+        """Сводка по самым затратным функциям (по накопленному времени)"""
+        stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+        return stream.getvalue()
+
+
+profiler = Profiler()
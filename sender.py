@@ -0,0 +1,297 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Optional
+
+from telegram.error import RetryAfter
+
+from profiling import record_span, span
+
+logger = logging.getLogger(__name__)
+
+# Полосы (lanes) исходящих запросов
+INTERACTIVE = "interactive"  # ответы пользователям: /start, кнопки, дата рождения
+BULK = "bulk"                # массовая рассылка еженедельных обновлений
+
+# Веса для взвешенной очереди: на 8 интерактивных отправок приходится 1 массовая,
+# поэтому рассылка не голодает, но и не задерживает ответы пользователям
+DEFAULT_WEIGHTS = {INTERACTIVE: 8, BULK: 1}
+
+# Глобальный лимит Telegram — около 30 сообщений в секунду, оставляем запас
+DEFAULT_RATE = 25.0
+
+
+class TokenBucket:
+    """Глобальный ограничитель частоты запросов к Telegram API"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def pause(self, seconds: float):
+        """Приостанавливает выдачу токенов (например, после RetryAfter от Telegram)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        """Ждет, пока не появится свободный токен, и забирает его"""
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                self.updated_at = time.monotonic()
+                continue
+
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def refund(self):
+        """Возвращает неиспользованный токен"""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class SendScheduler:
+    """
+    Единый планировщик исходящих запросов к Telegram.
+    Интерактивные ответы и массовая рассылка стоят в разных очередях,
+    делят общий лимит частоты и выбираются по весам (smooth weighted round robin).
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE, weights: dict = None, max_retries: int = 3):
+        self.weights = dict(weights or DEFAULT_WEIGHTS)
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate)
+
+        self._queues = {lane: deque() for lane in self.weights}
+        self._current_weights = {lane: 0 for lane in self.weights}
+        self._wakeup = None
+        self._worker = None
+        self._in_flight = set()
+
+        self._sent = {lane: 0 for lane in self.weights}
+        self._failed = {lane: 0 for lane in self.weights}
+        self._max_depth = {lane: 0 for lane in self.weights}
+        self._waits = {lane: deque(maxlen=1000) for lane in self.weights}
+        self._stats_since = time.monotonic()
+
+    def start(self):
+        """Запускает обработчик очередей (вызывать внутри работающего event loop)"""
+        if self._worker is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._worker = asyncio.create_task(self._run())
+        logger.info(f"Планировщик отправки запущен: {self.bucket.rate} запросов/с, веса {self.weights}")
+
+    async def stop(self):
+        """Останавливает обработчик очередей и дожидается запросов в полете"""
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+        for queue in self._queues.values():
+            while queue:
+                future = queue.popleft()[3]
+                if not future.done():
+                    future.cancel()
+
+    async def send(self, lane: str, func, *args, **kwargs):
+        """
+        Ставит вызов метода Telegram API в очередь указанной полосы
+        и возвращает его результат, когда запрос будет выполнен.
+        """
+        if lane not in self._queues:
+            raise ValueError(f"Неизвестная полоса отправки: {lane}")
+
+        api_name = f"api.{getattr(func, '__name__', 'call')}"
+
+        if self._worker is None:
+            # Планировщик не запущен (например, при отладке) — отправляем напрямую
+            with span(api_name):
+                return await func(*args, **kwargs)
+
+        # Время в очереди и время самого запроса замеряются раздельно,
+        # чтобы пауза RetryAfter не выглядела как медленная загрузка
+        future = asyncio.get_running_loop().create_future()
+        api_durations = []
+        enqueued_at = time.monotonic()
+        queue = self._queues[lane]
+        queue.append((func, args, kwargs, future, enqueued_at, 0, api_durations))
+        self._max_depth[lane] = max(self._max_depth[lane], len(queue))
+        self._wakeup.set()
+        try:
+            return await future
+        finally:
+            api_time = sum(api_durations)
+            record_span(f"queue.{lane}", max(0.0, time.monotonic() - enqueued_at - api_time))
+            record_span(api_name, api_time)
+
+    async def interactive(self, func, *args, **kwargs):
+        """Отправка в приоритетной полосе ответов пользователям"""
+        return await self.send(INTERACTIVE, func, *args, **kwargs)
+
+    async def bulk(self, func, *args, **kwargs):
+        """Отправка в низкоприоритетной полосе массовой рассылки"""
+        return await self.send(BULK, func, *args, **kwargs)
+
+    def _pick_lane(self) -> str:
+        """Выбирает непустую полосу по алгоритму smooth weighted round robin"""
+        active = [lane for lane, queue in self._queues.items() if queue]
+        total = 0
+        best = None
+        for lane in active:
+            self._current_weights[lane] += self.weights[lane]
+            total += self.weights[lane]
+            if best is None or self._current_weights[lane] > self._current_weights[best]:
+                best = lane
+        self._current_weights[best] -= total
+        return best
+
+    def _has_jobs(self) -> bool:
+        return any(self._queues.values())
+
+    def _drop_cancelled(self):
+        """Убирает из начала очередей запросы, ожидание которых уже отменено"""
+        for queue in self._queues.values():
+            while queue and queue[0][3].done():
+                queue.popleft()
+
+    async def _run(self):
+        while True:
+            self._drop_cancelled()
+            if not self._has_jobs():
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            # Сначала ждем токен, а полосу выбираем после: так интерактивный запрос,
+            # пришедший во время ожидания, обгонит уже стоящую рассылку
+            await self.bucket.acquire()
+
+            self._drop_cancelled()
+            if not self._has_jobs():
+                # Все запросы отменили, пока ждали токен
+                self.bucket.refund()
+                continue
+
+            lane = self._pick_lane()
+            job = self._queues[lane].popleft()
+            task = asyncio.create_task(self._execute(lane, job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _execute(self, lane: str, job: tuple):
+        func, args, kwargs, future, enqueued_at, attempt, api_durations = job
+        started_at = time.monotonic()
+        try:
+            # Повторная попытка должна отправить файл целиком, а не остаток потока
+            _rewind_streams(args, kwargs)
+            try:
+                result = await func(*args, **kwargs)
+            finally:
+                api_durations.append(time.monotonic() - started_at)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if not isinstance(retry_after, (int, float)):
+                retry_after = retry_after.total_seconds()
+            logger.warning(f"Telegram просит подождать {retry_after} с (полоса {lane})")
+            self.bucket.pause(retry_after)
+
+            if attempt < self.max_retries:
+                # Возвращаем запрос в начало своей полосы
+                self._queues[lane].appendleft((func, args, kwargs, future, enqueued_at, attempt + 1, api_durations))
+                self._wakeup.set()
+            else:
+                self._failed[lane] += 1
+                self._waits[lane].append(started_at - enqueued_at)
+                if not future.done():
+                    future.set_exception(e)
+        except Exception as e:
+            self._failed[lane] += 1
+            self._waits[lane].append(started_at - enqueued_at)
+            if not future.done():
+                future.set_exception(e)
+        else:
+            self._sent[lane] += 1
+            self._waits[lane].append(started_at - enqueued_at)
+            if not future.done():
+                future.set_result(result)
+
+    def reset_stats(self):
+        """Начинает новый период статистики (например, перед очередной рассылкой)"""
+        for lane in self.weights:
+            self._sent[lane] = 0
+            self._failed[lane] = 0
+            self._max_depth[lane] = len(self._queues[lane])
+            self._waits[lane].clear()
+        self._stats_since = time.monotonic()
+
+    def stats(self) -> dict:
+        """
+        Возвращает статистику по полосам с момента последнего reset_stats():
+        глубина очереди, отправлено, ошибки, ожидание.
+        """
+        result = {}
+        for lane in self.weights:
+            waits = sorted(self._waits[lane])
+            result[lane] = {
+                'depth': len(self._queues[lane]),
+                'max_depth': self._max_depth[lane],
+                'sent': self._sent[lane],
+                'failed': self._failed[lane],
+                'wait_p50': _percentile(waits, 0.50),
+                'wait_p99': _percentile(waits, 0.99),
+                'wait_max': waits[-1] if waits else 0.0,
+            }
+        result['in_flight'] = len(self._in_flight)
+        result['period'] = time.monotonic() - self._stats_since
+        return result
+
+    def log_stats(self):
+        """Пишет статистику очередей в лог"""
+        stats = self.stats()
+        logger.info(f"Статистика очередей за последние {stats['period']:.0f} с:")
+        for lane in self.weights:
+            lane_stats = stats[lane]
+            logger.info(
+                f"Очередь {lane}: глубина {lane_stats['depth']} (макс. {lane_stats['max_depth']}), "
+                f"отправлено {lane_stats['sent']}, ошибок {lane_stats['failed']}, "
+                f"ожидание p50={lane_stats['wait_p50'] * 1000:.0f} мс, "
+                f"p99={lane_stats['wait_p99'] * 1000:.0f} мс, "
+                f"макс.={lane_stats['wait_max'] * 1000:.0f} мс"
+            )
+
+
+def _rewind_streams(args: tuple, kwargs: dict):
+    """Перематывает в начало файловые объекты среди аргументов запроса"""
+    for value in list(args) + list(kwargs.values()):
+        seekable = getattr(value, 'seekable', None)
+        if seekable is not None and seekable():
+            value.seek(0)
+
+
+def _percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
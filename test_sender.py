@@ -0,0 +1,138 @@
+import asyncio
+import time
+from io import BytesIO
+
+import pytest
+from telegram.error import RetryAfter
+
+from sender import BULK, INTERACTIVE, SendScheduler, TokenBucket
+
+
+def test_token_bucket_limits_rate():
+    async def scenario():
+        bucket = TokenBucket(rate=20, capacity=1)
+        started_at = time.monotonic()
+        for _ in range(5):
+            await bucket.acquire()
+        return time.monotonic() - started_at
+
+    # Первый токен есть сразу, остальные 4 приходят по одному за 50 мс
+    assert asyncio.run(scenario()) >= 0.18
+
+
+def test_token_bucket_pause():
+    async def scenario():
+        bucket = TokenBucket(rate=100)
+        bucket.pause(0.1)
+        started_at = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - started_at
+
+    assert asyncio.run(scenario()) >= 0.09
+
+
+def test_lanes_interleave_by_weight():
+    async def scenario():
+        scheduler = SendScheduler(rate=1000)
+        scheduler.start()
+        order = []
+
+        async def send(lane):
+            order.append(lane)
+
+        tasks = [asyncio.create_task(scheduler.bulk(send, BULK)) for _ in range(18)]
+        tasks += [asyncio.create_task(scheduler.interactive(send, INTERACTIVE)) for _ in range(18)]
+        await asyncio.gather(*tasks)
+        await scheduler.stop()
+        return order
+
+    order = asyncio.run(scenario())
+    assert order[:9].count(INTERACTIVE) == 8
+    assert order[:9].count(BULK) == 1
+
+
+def test_retry_after_requeues_and_rewinds_stream():
+    async def scenario():
+        scheduler = SendScheduler(rate=1000)
+        scheduler.start()
+        payloads = []
+
+        async def send_photo(photo):
+            payloads.append(photo.read())
+            if len(payloads) == 1:
+                raise RetryAfter(0)
+            return len(payloads[-1])
+
+        result = await scheduler.bulk(send_photo, photo=BytesIO(b'x' * 100))
+        stats = scheduler.stats()
+        await scheduler.stop()
+        return result, payloads, stats
+
+    result, payloads, stats = asyncio.run(scenario())
+    assert result == 100
+    assert [len(payload) for payload in payloads] == [100, 100]
+    assert stats[BULK]['sent'] == 1
+    assert stats[BULK]['failed'] == 0
+
+
+def test_retry_after_gives_up_after_max_retries():
+    async def scenario():
+        scheduler = SendScheduler(rate=1000, max_retries=2)
+        scheduler.start()
+        calls = []
+
+        async def send_message():
+            calls.append(1)
+            raise RetryAfter(0)
+
+        try:
+            with pytest.raises(RetryAfter):
+                await scheduler.interactive(send_message)
+            return len(calls), scheduler.stats()
+        finally:
+            await scheduler.stop()
+
+    calls, stats = asyncio.run(scenario())
+    assert calls == 3
+    assert stats[INTERACTIVE]['failed'] == 1
+
+
+def test_wait_recorded_once_per_request():
+    async def scenario():
+        scheduler = SendScheduler(rate=1000)
+        scheduler.start()
+        attempts = []
+
+        async def send_message():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise RetryAfter(0)
+
+        await scheduler.interactive(send_message)
+        waits = list(scheduler._waits[INTERACTIVE])
+        await scheduler.stop()
+        return waits
+
+    assert len(asyncio.run(scenario())) == 1
+
+
+def test_cancelled_request_does_not_consume_token():
+    async def scenario():
+        scheduler = SendScheduler(rate=10)
+        scheduler.start()
+        calls = []
+
+        async def send_message():
+            calls.append(1)
+
+        task = asyncio.create_task(scheduler.interactive(send_message))
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.sleep(0.01)
+        tokens = scheduler.bucket.tokens
+        await scheduler.stop()
+        return calls, tokens, scheduler.bucket.capacity
+
+    calls, tokens, capacity = asyncio.run(scenario())
+    assert calls == []
+    assert tokens == capacity